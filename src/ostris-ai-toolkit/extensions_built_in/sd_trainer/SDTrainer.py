@@ -1019,7 +1019,7 @@ class SDTrainer(BaseSDTrainProcess):
                 with self.timer('get_adapter_images'):
                     # todo move this to data loader
                     if batch.control_tensor is not None:
-                        adapter_images = batch.control_tensor.to(self.device_torch, dtype=dtype).detach()
+                        adapter_images = batch.control_tensor.to(self.device_torch, dtype=dtype, non_blocking=True).detach()
                         # match in channels
                         if self.assistant_adapter is not None:
                             in_channels = self.assistant_adapter.config.in_channels
@@ -1034,13 +1034,13 @@ class SDTrainer(BaseSDTrainProcess):
                 with self.timer('get_clip_images'):
                     # todo move this to data loader
                     if batch.clip_image_tensor is not None:
-                        clip_images = batch.clip_image_tensor.to(self.device_torch, dtype=dtype).detach()
+                        clip_images = batch.clip_image_tensor.to(self.device_torch, dtype=dtype, non_blocking=True).detach()
 
             mask_multiplier = torch.ones((noisy_latents.shape[0], 1, 1, 1), device=self.device_torch, dtype=dtype)
             if batch.mask_tensor is not None:
                 with self.timer('get_mask_multiplier'):
                     # upsampling no supported for bfloat16
-                    mask_multiplier = batch.mask_tensor.to(self.device_torch, dtype=torch.float16).detach()
+                    mask_multiplier = batch.mask_tensor.to(self.device_torch, dtype=torch.float16, non_blocking=True).detach()
                     # scale down to the size of the latents, mask multiplier shape(bs, 1, width, height), noisy_latents shape(bs, channels, width, height)
                     mask_multiplier = torch.nn.functional.interpolate(
                         mask_multiplier, size=(noisy_latents.shape[2], noisy_latents.shape[3])
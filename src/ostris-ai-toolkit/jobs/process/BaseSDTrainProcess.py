@@ -857,13 +857,13 @@ class BaseSDTrainProcess(BaseTrainProcess):
                 is_reg = any(batch.get_is_reg_list())
                 if batch.tensor is not None:
                     imgs = batch.tensor
-                    imgs = imgs.to(self.device_torch, dtype=dtype)
+                    imgs = imgs.to(self.device_torch, dtype=dtype, non_blocking=True)
                     # dont adjust for regs.
                     if self.train_config.img_multiplier is not None and not is_reg:
                         # do it ad contrast
                         imgs = reduce_contrast(imgs, self.train_config.img_multiplier)
                 if batch.latents is not None:
-                    latents = batch.latents.to(self.device_torch, dtype=dtype)
+                    latents = batch.latents.to(self.device_torch, dtype=dtype, non_blocking=True)
                     batch.latents = latents
                 else:
                     # normalize to
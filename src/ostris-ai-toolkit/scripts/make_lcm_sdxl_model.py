@@ -5,6 +5,7 @@ import torch
 
 from ..toolkit.config_modules import ModelConfig
 from ..toolkit.stable_diffusion_model import StableDiffusion
+from ..toolkit.train_tools import get_torch_dtype
 
 
 parser = argparse.ArgumentParser()
@@ -22,10 +23,13 @@ parser.add_argument('--sdxl', action='store_true', help='is sdxl model')
 parser.add_argument('--refiner', action='store_true', help='is refiner model')
 parser.add_argument('--ssd', action='store_true', help='is ssd model')
 parser.add_argument('--sd2', action='store_true', help='is sd 2 model')
+parser.add_argument('--dtype', type=str, default='fp16', help='dtype to load and fuse the model in (fp16, bf16, fp32)')
 
 args = parser.parse_args()
 device = torch.device('cpu')
-dtype = torch.float32
+# fp16 halves memory over fp32 and matches the fp16 save, so fp16 source weights are not rounded.
+# peft computes the lora delta in fp32 on cpu before merging it. bf16 loses precision on fp16 checkpoints
+dtype = get_torch_dtype(args.dtype)
 
 print(f"Loading model from {args.input_path}")
 
@@ -57,7 +61,10 @@ diffusers_sd.load_model()
 print(f"Loaded model from {args.input_path}")
 
 diffusers_sd.pipeline.load_lora_weights(adapter_id)
+# merge the lora into the base weights, then strip the lora layers so the saved
+# model is a plain unet / text encoder with no adapter modules left in the graph
 diffusers_sd.pipeline.fuse_lora()
+diffusers_sd.pipeline.unload_lora_weights()
 
 meta = OrderedDict()
 
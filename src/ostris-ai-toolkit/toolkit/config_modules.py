@@ -638,11 +638,25 @@ class DatasetConfig:
 
         self.num_workers: int = kwargs.get('num_workers', 2)
         self.prefetch_factor: int = kwargs.get('prefetch_factor', 2)
+        # collate batches into page locked memory so host to device copies can be non blocking
+        self.pin_memory: bool = kwargs.get('pin_memory', False)
+        # return 4d image batches in channels last (NHWC) memory format
+        self.channels_last: bool = kwargs.get('channels_last', False)
         self.extra_values: List[float] = kwargs.get('extra_values', [])
         self.square_crop: bool = kwargs.get('square_crop', False)
         # apply same augmentations to control images. Usually want this true unless special case
         self.replay_transforms: bool = kwargs.get('replay_transforms', True)
 
+        # which optional tensors items in this dataset can have. Filled in by the dataset when it scans the files
+        # so batches can skip the rest. None means unknown and batches check every item.
+        self.has_control: Union[bool, None] = None
+        self.has_clip_image: Union[bool, None] = None
+        self.has_mask: Union[bool, None] = None
+        self.has_unaugmented: Union[bool, None] = None
+        self.has_unconditional: Union[bool, None] = None
+        # debug. Leave the flags above unknown so every batch checks every item for optional tensors
+        self.scan_batch_tensors: bool = kwargs.get('scan_batch_tensors', False)
+
 
 def preprocess_dataset_raw_config(raw_config: List[dict]) -> List[dict]:
     """
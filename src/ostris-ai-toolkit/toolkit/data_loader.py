@@ -2,6 +2,7 @@ import copy
 import json
 import os
 import random
+import tempfile
 import traceback
 from functools import lru_cache
 from typing import List, TYPE_CHECKING
@@ -94,8 +95,10 @@ class ImageDataset(Dataset, CaptionMixin):
         new_file_list = []
         bad_count = 0
         for file in tqdm(self.file_list):
-            img = Image.open(file)
-            if int(min(img.size) * self.scale) >= self.resolution:
+            # only the header is read for the size. min() does not care about exif orientation
+            with Image.open(file) as img:
+                img_size = img.size
+            if int(min(img_size) * self.scale) >= self.resolution:
                 new_file_list.append(file)
             else:
                 bad_count += 1
@@ -441,7 +444,7 @@ class AiToolkitDataset(LatentCachingMixin, CLIPCachingMixin, BucketsMixin, Capti
         if not os.path.isdir(self.dataset_path):
             dataset_folder = os.path.dirname(dataset_folder)
         dataset_size_file = os.path.join(dataset_folder, '.aitk_size.json')
-        dataloader_version = "0.1.1"
+        dataloader_version = "0.1.2"
         if os.path.exists(dataset_size_file):
             try:
                 with open(dataset_size_file, 'r') as f:
@@ -460,6 +463,11 @@ class AiToolkitDataset(LatentCachingMixin, CLIPCachingMixin, BucketsMixin, Capti
         
         self.size_database["__version__"] = dataloader_version
 
+        # read any unknown sizes in parallel so the loop below only hits the size database
+        validated_size_keys = FileItemDTO.prefetch_image_sizes(
+            file_list, self.size_database, dataset_root=dataset_folder
+        )
+
         bad_count = 0
         for file in tqdm(file_list):
             try:
@@ -469,6 +477,7 @@ class AiToolkitDataset(LatentCachingMixin, CLIPCachingMixin, BucketsMixin, Capti
                     dataset_config=dataset_config,
                     dataloader_transforms=self.transform,
                     size_database=self.size_database,
+                    validated_size_keys=validated_size_keys,
                     dataset_root=dataset_folder,
                 )
                 self.file_list.append(file_item)
@@ -478,14 +487,33 @@ class AiToolkitDataset(LatentCachingMixin, CLIPCachingMixin, BucketsMixin, Capti
                 print(e)
                 bad_count += 1
 
-        # save the size database
-        with open(dataset_size_file, 'w') as f:
-            json.dump(self.size_database, f)
+        # save the size database. Write to a temp file and swap it in so an interrupted
+        # run never leaves a truncated database behind. The temp file is unique so jobs
+        # starting on the same dataset do not write over each other
+        fd, tmp_dataset_size_file = tempfile.mkstemp(dir=dataset_folder, prefix='.aitk_size.', suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(self.size_database, f)
+            # mkstemp creates the file owner only, keep the usual permissions for the database
+            os.chmod(tmp_dataset_size_file, 0o644)
+            os.replace(tmp_dataset_size_file, dataset_size_file)
+        except Exception:
+            if os.path.exists(tmp_dataset_size_file):
+                os.remove(tmp_dataset_size_file)
+            raise
 
         print(f"  -  Found {len(self.file_list)} images")
         # print(f"  -  Found {bad_count} images that are too small")
         assert len(self.file_list) > 0, f"no images found in {self.dataset_path}"
 
+        if not self.dataset_config.scan_batch_tensors:
+            # record which optional tensors can show up so batches do not have to look for the rest
+            self.dataset_config.has_control = any(x.has_control_image for x in self.file_list)
+            self.dataset_config.has_clip_image = any(x.has_clip_image for x in self.file_list)
+            self.dataset_config.has_mask = any(x.has_mask_image for x in self.file_list)
+            self.dataset_config.has_unaugmented = any(x.has_augmentations for x in self.file_list)
+            self.dataset_config.has_unconditional = any(x.has_unconditional for x in self.file_list)
+
         # handle x axis flips
         if self.dataset_config.flip_x:
             print("  -  adding x axis flips")
@@ -596,10 +624,18 @@ def get_dataloader_from_datasets(
     # todo build scheduler that can get buckets from all datasets that match
     # todo and evenly distribute reg images
 
+    # which optional tensors any of the datasets can have. Worked out once here because the file items
+    # in a batch each carry a deep copy of their dataset config
+    optional_tensor_flags = {
+        key: any(getattr(dataset.dataset_config, key) is not False for dataset in datasets)
+        for key in ['has_control', 'has_clip_image', 'has_mask', 'has_unaugmented', 'has_unconditional']
+    }
+
     def dto_collation(batch: List['FileItemDTO']):
         # create DTO batch
         batch = DataLoaderBatchDTO(
-            file_items=batch
+            file_items=batch,
+            **optional_tensor_flags
         )
         return batch
 
@@ -613,6 +649,10 @@ def get_dataloader_from_datasets(
         dataloader_kwargs['num_workers'] = dataset_config_list[0].num_workers
         dataloader_kwargs['prefetch_factor'] = dataset_config_list[0].prefetch_factor
 
+    if dataset_config_list[0].pin_memory and torch.cuda.is_available():
+        # the dataloader pin thread calls DataLoaderBatchDTO.pin_memory in the main process
+        dataloader_kwargs['pin_memory'] = True
+
     if has_buckets:
         # make sure they all have buckets
         for dataset in datasets:
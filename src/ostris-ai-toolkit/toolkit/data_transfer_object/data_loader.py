@@ -1,14 +1,16 @@
 import os
 import weakref
+from concurrent.futures import ThreadPoolExecutor
 from _weakref import ReferenceType
 from typing import TYPE_CHECKING, List, Union
+import numpy as np
 import torch
 import random
+from torch.utils.data import get_worker_info
 
 from PIL import Image
-from PIL.ImageOps import exif_transpose
+from tqdm import tqdm
 
-from ...toolkit import image_utils
 from ...toolkit.dataloader_mixins import CaptionProcessingDTOMixin, ImageProcessingDTOMixin, LatentCachingFileItemDTOMixin, \
     ControlFileItemDTOMixin, ArgBreakMixin, PoiFileItemDTOMixin, MaskFileItemDTOMixin, AugmentationFileItemDTOMixin, \
     UnconditionalFileItemDTOMixin, ClipImageFileItemDTOMixin
@@ -18,14 +20,80 @@ if TYPE_CHECKING:
     from ...toolkit.config_modules import DatasetConfig
     from ...toolkit.stable_diffusion_model import StableDiffusion
 
-printed_messages = []
+printed_messages = set()
 
 
 def print_once(msg):
     global printed_messages
     if msg not in printed_messages:
         print(msg)
-        printed_messages.append(msg)
+        printed_messages.add(msg)
+
+
+def new_batch_tensor(base: torch.Tensor, batch_size: int, channels_last: bool = False) -> torch.Tensor:
+    # uninitialized (batch_size, *base.shape) tensor. Inside a dataloader worker it is allocated in shared
+    # memory, the same way torch's default_collate does, so sending the batch to the main process is not
+    # another copy. With channels_last, 4d batches are laid out NHWC so stacking into them does the
+    # layout change in the same pass
+    shape = (batch_size, *base.shape)
+    memory_format = torch.channels_last if channels_last and len(shape) == 4 else torch.contiguous_format
+    if get_worker_info() is not None and base.device.type == 'cpu':
+        storage = base._typed_storage()._new_shared(batch_size * base.numel(), device=base.device)
+        stride = torch.empty(shape, device='meta', memory_format=memory_format).stride()
+        return base.new(storage).as_strided(shape, stride)
+    return torch.empty(shape, dtype=base.dtype, device=base.device, memory_format=memory_format)
+
+
+def stack_tensors(tensors: List[torch.Tensor], channels_last: bool = False) -> torch.Tensor:
+    return torch.stack(tensors, dim=0, out=new_batch_tensor(tensors[0], len(tensors), channels_last))
+
+
+def stack_with_zeros(
+        tensors: List[Union[torch.Tensor, None]],
+        base: torch.Tensor,
+        channels_last: bool = False
+) -> torch.Tensor:
+    # stacks the tensors, leaving zeros where an item is None.
+    # allocates the batch once instead of a zeros_like for every missing item, and
+    # only the missing slots are zeroed so present ones are written once
+    if all(t is not None for t in tensors):
+        return stack_tensors(tensors, channels_last)
+    out = new_batch_tensor(base, len(tensors), channels_last)
+    for i, t in enumerate(tensors):
+        if t is None:
+            out[i].zero_()
+        else:
+            out[i].copy_(t)
+    return out
+
+
+def get_size_database_key(path: str, dataset_root: Union[str, None] = None) -> str:
+    if dataset_root is not None:
+        # remove dataset root from path
+        return path.replace(dataset_root, '')
+    return os.path.basename(path)
+
+
+def get_file_signature(path: str) -> List[int]:
+    file_stat = os.stat(path)
+    return [file_stat.st_size, int(file_stat.st_mtime)]
+
+
+def read_image_size(path: str):
+    # image_utils.get_image_size is faster, but it ignores exif orientation so some images are read sideways.
+    # only the header is parsed here. exif_transpose would decode the whole image just to get the size.
+    # orientations 5-8 are rotated 90 degrees, so the stored width and height are swapped
+    with Image.open(path) as img:
+        w, h = img.size
+        # png getexif loads the whole image when the exif chunk is not before the pixel data, so only
+        # use exif from the header. A png exif chunk after the pixel data is ignored
+        if img.format != 'PNG' or 'exif' in img.info:
+            orientation = img.getexif().get(0x0112, 1)
+        else:
+            orientation = 1
+    if orientation in (5, 6, 7, 8):
+        w, h = h, w
+    return w, h
 
 
 class FileItemDTO(
@@ -40,29 +108,56 @@ class FileItemDTO(
     PoiFileItemDTOMixin,
     ArgBreakMixin,
 ):
+    # there is one of these per image in the dataset, so skip the per instance __dict__.
+    # every attribute set on a file item, including the ones the mixins set, must be listed here.
+    # the mixins use empty __slots__, only one class in the mro can have non-empty slots
+    __slots__ = (
+        # FileItemDTO
+        'path', 'dataset_config', 'width', 'height', 'dataloader_transforms', 'raw_caption',
+        'scale_to_width', 'scale_to_height', 'crop_x', 'crop_y', 'crop_width', 'crop_height',
+        'flip_x', 'flip_y', 'augments', 'loss_multiplier', 'network_weight', 'is_reg', 'tensor',
+        # LatentCachingFileItemDTOMixin
+        '_encoded_latent', '_latent_path', 'is_latent_cached', 'is_caching_to_disk', 'is_caching_to_memory',
+        'latent_load_device', 'latent_space_version', 'latent_version',
+        # CaptionProcessingDTOMixin
+        'caption', 'raw_caption_short', 'caption_short', 'extra_values',
+        # ControlFileItemDTOMixin
+        'has_control_image', 'control_path', 'control_tensor', 'full_size_control_images',
+        # ClipImageFileItemDTOMixin
+        'has_clip_image', 'clip_image_path', 'clip_image_tensor', 'clip_image_embeds',
+        'clip_image_embeds_unconditional', 'has_clip_augmentations', 'clip_image_aug_transform',
+        'clip_image_processor', 'clip_image_encoder_path', 'is_caching_clip_vision_to_disk',
+        'is_vision_clip_cached', 'clip_vision_is_quad', 'clip_vision_load_device',
+        'clip_vision_unconditional_paths', '_clip_vision_embeddings_path',
+        # MaskFileItemDTOMixin
+        'has_mask_image', 'mask_path', 'mask_tensor', 'use_alpha_as_mask', 'mask_min_value',
+        # AugmentationFileItemDTOMixin
+        'has_augmentations', 'unaugmented_tensor', 'aug_transform', 'aug_replay_spatial_transforms',
+        # UnconditionalFileItemDTOMixin
+        'has_unconditional', 'unconditional_path', 'unconditional_tensor', 'unconditional_latent',
+        'unconditional_transforms',
+        # PoiFileItemDTOMixin
+        'poi', 'has_point_of_interest', 'poi_x', 'poi_y', 'poi_width', 'poi_height',
+    )
+
     def __init__(self, *args, **kwargs):
         self.path = kwargs.get('path', '')
         self.dataset_config: 'DatasetConfig' = kwargs.get('dataset_config', None)
         size_database = kwargs.get('size_database', {})
         dataset_root =  kwargs.get('dataset_root', None)
-        if dataset_root is not None:
-            # remove dataset root from path
-            file_key = self.path.replace(dataset_root, '')
+        # keys prefetch_image_sizes already checked against the file, so they can be used without a stat
+        validated_size_keys = kwargs.get('validated_size_keys', None)
+        file_key = get_size_database_key(self.path, dataset_root)
+        if validated_size_keys is not None and file_key in validated_size_keys:
+            w, h = size_database[file_key][:2]
         else:
-            file_key = os.path.basename(self.path)
-        if file_key in size_database:
-            w, h = size_database[file_key]
-        else:
-            # original method is significantly faster, but some images are read sideways. Not sure why. Do slow method for now.
-            # process width and height
-            # try:
-            #     w, h = image_utils.get_image_size(self.path)
-            # except image_utils.UnknownImageFormat:
-            #     print_once(f'Warning: Some images in the dataset cannot be fast read. ' + \
-            #                f'This process is faster for png, jpeg')
-            img = exif_transpose(Image.open(self.path))
-            w, h = img.size
-            size_database[file_key] = (w, h)
+            # file size and mtime are stored with the dimensions so edited images get re-measured
+            file_signature = get_file_signature(self.path)
+            if file_key in size_database and size_database[file_key][2:] == file_signature:
+                w, h = size_database[file_key][:2]
+            else:
+                w, h = read_image_size(self.path)
+                size_database[file_key] = [w, h, *file_signature]
         self.width: int = w
         self.height: int = h
         self.dataloader_transforms = kwargs.get('dataloader_transforms', None)
@@ -79,7 +174,7 @@ class FileItemDTO(
         self.crop_width: int = kwargs.get('crop_width', self.scale_to_width)
         self.crop_height: int = kwargs.get('crop_height', self.scale_to_height)
         self.flip_x: bool = kwargs.get('flip_x', False)
-        self.flip_y: bool = kwargs.get('flip_x', False)
+        self.flip_y: bool = kwargs.get('flip_y', False)
         self.augments: List[str] = self.dataset_config.augments
         self.loss_multiplier: float = self.dataset_config.loss_multiplier
 
@@ -87,6 +182,40 @@ class FileItemDTO(
         self.is_reg = self.dataset_config.is_reg
         self.tensor: Union[torch.Tensor, None] = None
 
+    @classmethod
+    def prefetch_image_sizes(
+            cls,
+            paths: List[str],
+            size_database: dict,
+            dataset_root: Union[str, None] = None,
+            max_workers: int = 16
+    ) -> set:
+        # checks the size database against the files and reads the sizes of missing or stale images on a
+        # thread pool. Stats and header reads are io bound and release the GIL, so this hides most of the
+        # disk latency on large datasets. Returns the keys that are now current, pass them to FileItemDTO
+        # as validated_size_keys so it does not stat again. Files that fail are left out and will raise
+        # when their FileItemDTO is built.
+        def read_size(path):
+            file_key = get_size_database_key(path, dataset_root)
+            try:
+                file_signature = get_file_signature(path)
+                if file_key in size_database and size_database[file_key][2:] == file_signature:
+                    return file_key, True, None
+                return file_key, True, [*read_image_size(path), *file_signature]
+            except Exception:
+                return file_key, False, None
+
+        unique_paths = list(dict.fromkeys(paths))
+        validated_size_keys = set()
+        # only the main thread writes to the size database
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for file_key, is_valid, size in tqdm(executor.map(read_size, unique_paths), total=len(unique_paths)):
+                if size is not None:
+                    size_database[file_key] = size
+                if is_valid:
+                    validated_size_keys.add(file_key)
+        return validated_size_keys
+
     def cleanup(self):
         self.tensor = None
         self.cleanup_latent()
@@ -101,6 +230,8 @@ class DataLoaderBatchDTO:
         try:
             self.file_items: List['FileItemDTO'] = kwargs.get('file_items', None)
             is_latents_cached = self.file_items[0].is_latent_cached
+            # image batches are stacked straight into NHWC when the dataset asks for channels last
+            channels_last = self.file_items[0].dataset_config.channels_last
             self.tensor: Union[torch.Tensor, None] = None
             self.latents: Union[torch.Tensor, None] = None
             self.control_tensor: Union[torch.Tensor, None] = None
@@ -112,97 +243,115 @@ class DataLoaderBatchDTO:
             self.clip_image_embeds: Union[List[dict], None] = None
             self.clip_image_embeds_unconditional: Union[List[dict], None] = None
             self.sigmas: Union[torch.Tensor, None] = None  # can be added elseware and passed along training code
-            self.extra_values: Union[torch.Tensor, None] = torch.tensor([x.extra_values for x in self.file_items]) if len(self.file_items[0].extra_values) > 0 else None
+            self.extra_values: Union[torch.Tensor, None] = None
+            num_extra_values = len(self.file_items[0].extra_values)
+            if num_extra_values > 0:
+                # fromiter would silently shift rows if the lengths differ, so check them first
+                if any(len(x.extra_values) != num_extra_values for x in self.file_items):
+                    raise ValueError(
+                        f"extra_values must be the same length for every item in a batch, "
+                        f"got {[len(x.extra_values) for x in self.file_items]}"
+                    )
+                # fill a flat float32 array directly instead of letting torch infer from nested lists
+                extra_values = np.fromiter(
+                    (v for x in self.file_items for v in x.extra_values),
+                    dtype=np.float32,
+                    count=len(self.file_items) * num_extra_values
+                ).reshape(len(self.file_items), num_extra_values)
+                self.extra_values = torch.from_numpy(extra_values)
             if not is_latents_cached:
                 # only return a tensor if latents are not cached
-                self.tensor: torch.Tensor = torch.cat([x.tensor.unsqueeze(0) for x in self.file_items])
+                self.tensor: torch.Tensor = stack_tensors([x.tensor for x in self.file_items], channels_last)
             # if we have encoded latents, we concatenate them
             self.latents: Union[torch.Tensor, None] = None
             if is_latents_cached:
-                self.latents = torch.cat([x.get_latent().unsqueeze(0) for x in self.file_items])
-            self.control_tensor: Union[torch.Tensor, None] = None
-            # if self.file_items[0].control_tensor is not None:
-            # if any have a control tensor, we concatenate them
-            if any([x.control_tensor is not None for x in self.file_items]):
-                # find one to use as a base
-                base_control_tensor = None
+                self.latents = stack_tensors([x.get_latent() for x in self.file_items])
+                # the image tensors are never used when training on cached latents, drop any that were loaded
                 for x in self.file_items:
-                    if x.control_tensor is not None:
-                        base_control_tensor = x.control_tensor
-                        break
-                control_tensors = []
-                for x in self.file_items:
-                    if x.control_tensor is None:
-                        control_tensors.append(torch.zeros_like(base_control_tensor))
-                    else:
-                        control_tensors.append(x.control_tensor)
-                self.control_tensor = torch.cat([x.unsqueeze(0) for x in control_tensors])
+                    x.tensor = None
+            # the dataloader passes which optional tensors its datasets can have, so we only look at those.
+            # None means unknown, so we check the items
+            check_control = kwargs.get('has_control', None) is not False
+            check_clip_image = kwargs.get('has_clip_image', None) is not False
+            check_mask = kwargs.get('has_mask', None) is not False
+            check_unaugmented = kwargs.get('has_unaugmented', None) is not False
+            check_unconditional = kwargs.get('has_unconditional', None) is not False
 
-            self.loss_multiplier_list: List[float] = [x.loss_multiplier for x in self.file_items]
+            # gather everything we need from the file items in a single pass,
+            # keeping the first tensor of each kind to use as a base
+            base_control_tensor = None
+            base_clip_image_tensor = None
+            base_mask_tensor = None
+            base_unaugmented_tensor = None
+            base_unconditional_tensor = None
+            has_clip_image_embeds = False
+            has_clip_image_embeds_unconditional = False
+            control_tensors = []
+            clip_image_tensors = []
+            mask_tensors = []
+            unaugmented_tensors = []
+            unconditional_tensors = []
+            self.loss_multiplier_list: List[float] = []
+            self._is_reg_list: List[bool] = []
+            self._network_weight_list: List[float] = []
+            self._caption_list: List[str] = []
+            self._caption_short_list: List[str] = []
+            for x in self.file_items:
+                if check_control:
+                    control_tensor = x.control_tensor
+                    if base_control_tensor is None and control_tensor is not None:
+                        base_control_tensor = control_tensor
+                    control_tensors.append(control_tensor)
+                if check_clip_image:
+                    clip_image_tensor = x.clip_image_tensor
+                    if base_clip_image_tensor is None and clip_image_tensor is not None:
+                        base_clip_image_tensor = clip_image_tensor
+                    clip_image_tensors.append(clip_image_tensor)
+                    if x.clip_image_embeds is not None:
+                        has_clip_image_embeds = True
+                    if x.clip_image_embeds_unconditional is not None:
+                        has_clip_image_embeds_unconditional = True
+                if check_mask:
+                    mask_tensor = x.mask_tensor
+                    if base_mask_tensor is None and mask_tensor is not None:
+                        base_mask_tensor = mask_tensor
+                    mask_tensors.append(mask_tensor)
+                if check_unaugmented:
+                    unaugmented_tensor = x.unaugmented_tensor
+                    if base_unaugmented_tensor is None and unaugmented_tensor is not None:
+                        base_unaugmented_tensor = unaugmented_tensor
+                    unaugmented_tensors.append(unaugmented_tensor)
+                if check_unconditional:
+                    unconditional_tensor = x.unconditional_tensor
+                    if base_unconditional_tensor is None and unconditional_tensor is not None:
+                        base_unconditional_tensor = unconditional_tensor
+                    unconditional_tensors.append(unconditional_tensor)
+                # these are static for the life of the batch, so build them once
+                self.loss_multiplier_list.append(x.loss_multiplier)
+                self._is_reg_list.append(x.is_reg)
+                self._network_weight_list.append(x.network_weight)
+                self._caption_list.append(x.caption)
+                self._caption_short_list.append(x.caption_short)
 
-            if any([x.clip_image_tensor is not None for x in self.file_items]):
-                # find one to use as a base
-                base_clip_image_tensor = None
-                for x in self.file_items:
-                    if x.clip_image_tensor is not None:
-                        base_clip_image_tensor = x.clip_image_tensor
-                        break
-                clip_image_tensors = []
-                for x in self.file_items:
-                    if x.clip_image_tensor is None:
-                        clip_image_tensors.append(torch.zeros_like(base_clip_image_tensor))
-                    else:
-                        clip_image_tensors.append(x.clip_image_tensor)
-                self.clip_image_tensor = torch.cat([x.unsqueeze(0) for x in clip_image_tensors])
+            # if any have a control tensor, we concatenate them
+            if base_control_tensor is not None:
+                self.control_tensor = stack_with_zeros(control_tensors, base_control_tensor, channels_last)
 
-            if any([x.mask_tensor is not None for x in self.file_items]):
-                # find one to use as a base
-                base_mask_tensor = None
-                for x in self.file_items:
-                    if x.mask_tensor is not None:
-                        base_mask_tensor = x.mask_tensor
-                        break
-                mask_tensors = []
-                for x in self.file_items:
-                    if x.mask_tensor is None:
-                        mask_tensors.append(torch.zeros_like(base_mask_tensor))
-                    else:
-                        mask_tensors.append(x.mask_tensor)
-                self.mask_tensor = torch.cat([x.unsqueeze(0) for x in mask_tensors])
+            if base_clip_image_tensor is not None:
+                self.clip_image_tensor = stack_with_zeros(clip_image_tensors, base_clip_image_tensor)
+
+            if base_mask_tensor is not None:
+                self.mask_tensor = stack_with_zeros(mask_tensors, base_mask_tensor, channels_last)
 
             # add unaugmented tensors for ones with augments
-            if any([x.unaugmented_tensor is not None for x in self.file_items]):
-                # find one to use as a base
-                base_unaugmented_tensor = None
-                for x in self.file_items:
-                    if x.unaugmented_tensor is not None:
-                        base_unaugmented_tensor = x.unaugmented_tensor
-                        break
-                unaugmented_tensor = []
-                for x in self.file_items:
-                    if x.unaugmented_tensor is None:
-                        unaugmented_tensor.append(torch.zeros_like(base_unaugmented_tensor))
-                    else:
-                        unaugmented_tensor.append(x.unaugmented_tensor)
-                self.unaugmented_tensor = torch.cat([x.unsqueeze(0) for x in unaugmented_tensor])
+            if base_unaugmented_tensor is not None:
+                self.unaugmented_tensor = stack_with_zeros(unaugmented_tensors, base_unaugmented_tensor, channels_last)
 
             # add unconditional tensors
-            if any([x.unconditional_tensor is not None for x in self.file_items]):
-                # find one to use as a base
-                base_unconditional_tensor = None
-                for x in self.file_items:
-                    if x.unaugmented_tensor is not None:
-                        base_unconditional_tensor = x.unconditional_tensor
-                        break
-                unconditional_tensor = []
-                for x in self.file_items:
-                    if x.unconditional_tensor is None:
-                        unconditional_tensor.append(torch.zeros_like(base_unconditional_tensor))
-                    else:
-                        unconditional_tensor.append(x.unconditional_tensor)
-                self.unconditional_tensor = torch.cat([x.unsqueeze(0) for x in unconditional_tensor])
+            if base_unconditional_tensor is not None:
+                self.unconditional_tensor = stack_with_zeros(unconditional_tensors, base_unconditional_tensor, channels_last)
 
-            if any([x.clip_image_embeds is not None for x in self.file_items]):
+            if has_clip_image_embeds:
                 self.clip_image_embeds = []
                 for x in self.file_items:
                     if x.clip_image_embeds is not None:
@@ -210,7 +359,7 @@ class DataLoaderBatchDTO:
                     else:
                         raise Exception("clip_image_embeds is None for some file items")
 
-            if any([x.clip_image_embeds_unconditional is not None for x in self.file_items]):
+            if has_clip_image_embeds_unconditional:
                 self.clip_image_embeds_unconditional = []
                 for x in self.file_items:
                     if x.clip_image_embeds_unconditional is not None:
@@ -222,11 +371,30 @@ class DataLoaderBatchDTO:
             print(e)
             raise e
 
+    def pin_memory(self):
+        # called by the torch DataLoader pin memory thread when pin_memory is enabled.
+        # pinned allocations are reused by the cuda host caching allocator
+        for attr in [
+            'tensor',
+            'latents',
+            'control_tensor',
+            'clip_image_tensor',
+            'mask_tensor',
+            'unaugmented_tensor',
+            'unconditional_tensor',
+            'unconditional_latents',
+            'extra_values',
+        ]:
+            value = getattr(self, attr, None)
+            if isinstance(value, torch.Tensor) and value.device.type == 'cpu' and not value.is_pinned():
+                setattr(self, attr, value.pin_memory())
+        return self
+
     def get_is_reg_list(self):
-        return [x.is_reg for x in self.file_items]
+        return list(self._is_reg_list)
 
     def get_network_weight_list(self):
-        return [x.network_weight for x in self.file_items]
+        return list(self._network_weight_list)
 
     def get_caption_list(
             self,
@@ -234,7 +402,7 @@ class DataLoaderBatchDTO:
             to_replace_list=None,
             add_if_not_present=True
     ):
-        return [x.caption for x in self.file_items]
+        return list(self._caption_list)
 
     def get_caption_short_list(
             self,
@@ -242,11 +410,15 @@ class DataLoaderBatchDTO:
             to_replace_list=None,
             add_if_not_present=True
     ):
-        return [x.caption_short for x in self.file_items]
+        return list(self._caption_short_list)
 
     def cleanup(self):
         del self.latents
         del self.tensor
         del self.control_tensor
+        self._is_reg_list = None
+        self._network_weight_list = None
+        self._caption_list = None
+        self._caption_short_list = None
         for file_item in self.file_items:
             file_item.cleanup()
@@ -282,6 +282,8 @@ class BucketsMixin:
 
 
 class CaptionProcessingDTOMixin:
+    __slots__ = ()
+
     def __init__(self: 'FileItemDTO', *args, **kwargs):
         if hasattr(super(), '__init__'):
             super().__init__(*args, **kwargs)
@@ -426,6 +428,8 @@ class CaptionProcessingDTOMixin:
 
 
 class ImageProcessingDTOMixin:
+    __slots__ = ()
+
     def load_and_process_image(
             self: 'FileItemDTO',
             transform: Union[None, transforms.Compose],
@@ -445,6 +449,14 @@ class ImageProcessingDTOMixin:
             return
         try:
             img = Image.open(self.path)
+            if self.dataset_config.buckets:
+                # let libjpeg downscale during decode. It never goes below the requested size, the resize
+                # below still sets the exact size. Does nothing for non jpeg images
+                draft_size = (self.scale_to_width, self.scale_to_height)
+                if img.getexif().get(0x0112, 1) in (5, 6, 7, 8):
+                    # draft works on the stored orientation, before exif_transpose
+                    draft_size = (self.scale_to_height, self.scale_to_width)
+                img.draft('RGB', draft_size)
             img = exif_transpose(img)
         except Exception as e:
             print(f"Error: {e}")
@@ -540,6 +552,8 @@ class ImageProcessingDTOMixin:
 
 
 class ControlFileItemDTOMixin:
+    __slots__ = ()
+
     def __init__(self: 'FileItemDTO', *args, **kwargs):
         if hasattr(super(), '__init__'):
             super().__init__(*args, **kwargs)
@@ -619,6 +633,8 @@ class ControlFileItemDTOMixin:
 
 
 class ClipImageFileItemDTOMixin:
+    __slots__ = ()
+
     def __init__(self: 'FileItemDTO', *args, **kwargs):
         if hasattr(super(), '__init__'):
             super().__init__(*args, **kwargs)
@@ -845,6 +861,8 @@ class ClipImageFileItemDTOMixin:
 
 
 class AugmentationFileItemDTOMixin:
+    __slots__ = ()
+
     def __init__(self: 'FileItemDTO', *args, **kwargs):
         if hasattr(super(), '__init__'):
             super().__init__(*args, **kwargs)
@@ -950,6 +968,8 @@ class AugmentationFileItemDTOMixin:
 
 
 class MaskFileItemDTOMixin:
+    __slots__ = ()
+
     def __init__(self: 'FileItemDTO', *args, **kwargs):
         if hasattr(super(), '__init__'):
             super().__init__(*args, **kwargs)
@@ -1059,6 +1079,8 @@ class MaskFileItemDTOMixin:
 
 
 class UnconditionalFileItemDTOMixin:
+    __slots__ = ()
+
     def __init__(self: 'FileItemDTO', *args, **kwargs):
         if hasattr(super(), '__init__'):
             super().__init__(*args, **kwargs)
@@ -1133,6 +1155,8 @@ class UnconditionalFileItemDTOMixin:
 class PoiFileItemDTOMixin:
     # Point of interest bounding box. Allows for dynamic cropping without cropping out the main subject
     # items in the poi will always be inside the image when random cropping
+    __slots__ = ()
+
     def __init__(self: 'FileItemDTO', *args, **kwargs):
         if hasattr(super(), '__init__'):
             super().__init__(*args, **kwargs)
@@ -1286,11 +1310,15 @@ class PoiFileItemDTOMixin:
 
 class ArgBreakMixin:
     # just stops super calls form hitting object
+    __slots__ = ()
+
     def __init__(self, *args, **kwargs):
         pass
 
 
 class LatentCachingFileItemDTOMixin:
+    __slots__ = ()
+
     def __init__(self, *args, **kwargs):
         # if we have super, call it
         if hasattr(super(), '__init__'):